@@ -8,13 +8,21 @@ This program is a curses front end to pyparted that mimics cfdisk.
 """
 import curses
 import curses.textpad
+import fcntl
+import hashlib
+import json
+import os
+import re
+import struct
 import sys
+import zlib
 
 import parted
 
 __version__ = "0.1"
 
 DEBUG = None
+CACHE = None
 PART_TABLE = 10 # Where to start listing partitions from.
 PART_TYPES = ("Logical", "Extended", "Free Space", "Metadata", "Protected")
 DEVICE_TYPES = ("Unknown", "SCSI", "IDE", "DAC960", "CPQ Array", "File",
@@ -27,20 +35,47 @@ END = 1
 NAME = 0
 FUNC = 1
 
+LEVEL = 2 # Problems are (start, end, level, message) tuples.
+MESSAGE = 3
+
+BACKUP_MAGIC = b"CPBK"
+BACKUP_VERSION = 1
+BACKUP_HEADER = "<4sBIQH" # magic, version, sector size, sectors, serial length
+GPT_SIGNATURE = b"EFI PART"
+MSDOS_EXTENDED = (0x05, 0x0f, 0x85)
+# Partition types that are regions of the disk rather than partitions.
+SPACE_TYPES = (parted.PARTITION_FREESPACE | parted.PARTITION_METADATA |
+               parted.PARTITION_PROTECTED | parted.PARTITION_EXTENDED)
+BLKRRPART = 0x125f # ioctl asking the kernel to re-read the partition table.
+CACHE_VERSION = 2
+
 
 class Menu(object):
     """Holds the state of the options menu and partition table, provides
        functions for drawing them, and contains the options functions."""
 
-    def __init__(self, window, device):
+    def __init__(self, window, device, cache=None):
         self.meta_opts = (("Help", self.help_), ("Units", self.units),
                           ("Write", self.write), ("Print", self.print_),
                           ("New Table", self.new_table), ("Quit", self.quit))
-        self.part_opts = (("Delete", self.delete), ("Bootable", self.bootable)) + self.meta_opts
+        # Options only reached by their keys, to keep the menu within 80 columns.
+        self.key_opts = (("Backup", self.backup), ("Restore", self.restore))
+        self.part_opts = (("Delete", self.delete), ("Bootable", self.bootable),
+                          ("Align", self.align)) + self.meta_opts
         self.free_opts = (("New", self.new),) + self.meta_opts
+        # Options that can be used before the disk has been probed.
+        self.cached_opts = (self.help_, self.units, self.print_, self.backup,
+                            self.restore, self.align, self.quit)
         self.device = device
-        self.disk = parted.Disk(device)
-        self.partitions = get_partitions(self.disk, debug=DEBUG)
+        self.alignments = alignment_requirements(device)
+        if cache is None:
+            self.load_disk()
+        else:
+            self.disk = None
+            self.partitions = None
+            self.label_type = cache["type"]
+            self.rows = cache["debug" if DEBUG else "partitions"]
+            self.problems = cache["problems"]
         self.select_partition(0)
         self.window = window
         if DEBUG is None:
@@ -50,8 +85,8 @@ class Menu(object):
 
     @property
     def table_fields(self):
-        return ("Name", "Flags", "Part Type", "FS Type", "Size({:})".
-                format(self.unit))
+        return ("Name", "Flags", "Part Type", "FS Type", "Align",
+                "Size({:})".format(self.unit))
 
     @property
     def header(self):
@@ -68,7 +103,7 @@ class Menu(object):
                    DEVICE_TYPES[self.device.type], self.device.length,
                    self.device.getLength("GB"),
                    self.device.sectorSize, self.device.physicalSectorSize,
-                   self.disk.type)
+                   self.label_type)
         header = ""
         for line in text.splitlines():
             header += "{:^{:}}".format(line, self.window_width)
@@ -79,47 +114,69 @@ class Menu(object):
     @property
     def partitions_data(self):
         """A tuple holding the partition data to be displayed by Menu."""
-        def if_active(part, fn):
-            if part.active:
-                return fn()
-            return ""
-
-        def fs_type(part):
-            if part.fileSystem:
-                return part.fileSystem.type
-            elif part.type & parted.PARTITION_FREESPACE:
-                return "Free Space"
-            else:
+        def align(type_, start):
+            if type_ & SPACE_TYPES:
                 return ""
-
-        def part_type(part):
-            if part.type & parted.PARTITION_FREESPACE:
-                return check_free_space(part)
-            elif part.type == parted.PARTITION_NORMAL:
-                return "Primary"
-            flags = []
-            for flag, value in zip(bin(part.type)[::-1], PART_TYPES):
-                if flag == "1":
-                    flags.append(value)
-            return ", ".join(flags)
+            return ",".join(check_alignment(self.alignments, start)) or "OK"
 
         data = ()
-        for part in self.partitions:
-            data += ((if_active(part, part.getDeviceNodeName),
-                      if_active(part, part.getFlagsAsString),
-                      part_type(part), fs_type(part),
-                      int(part.getLength(self.unit))),)
+        for type_, node, flags, part_type, fs_type, start, end, low, high \
+                in self.rows:
+            if self.part_problems(start, end):
+                node = "!" + node
+            data += ((node, flags, part_type, fs_type, align(type_, start),
+                      self.size(end - start + 1)),)
         return data
 
+    def size(self, sectors):
+        """Convert a number of sectors to the current unit."""
+        if self.unit == "sectors":
+            return sectors
+        return int(parted.formatBytes(sectors * self.device.sectorSize,
+                                      self.unit))
+
+    def realignment(self, i, short=False):
+        """Describe how to align the partition in row i of the table.
+
+        The start of the partition is moved by the smallest shift that meets
+        all of the alignment requirements, into the free space next to it if
+        needed. If short is True, the description fits on the information
+        line. Returns None if row i is not a partition or is already aligned.
+
+        """
+        type_, node, flags, part_type, fs_type, start, end, low, high = \
+            self.rows[i]
+        if type_ & SPACE_TYPES or not check_alignment(self.alignments, start):
+            return None
+        length = end - start + 1
+        moved = length * self.device.sectorSize
+        if short:
+            text = "{2:+d} sectors, {4:} to move"
+            moved = format_bytes(moved)
+        else:
+            text = "{0:}: move start from sector {1:} to {3:} ({2:+d}), " \
+                   "moving {4:,} bytes"
+
+        new_start = plan_realignment(self.alignments, start, length, low, high)
+        if new_start is None:
+            new_start = plan_realignment(self.alignments, start, length,
+                                         start, None)
+            if new_start is None:
+                return "{:}: the alignments can not all be met".format(
+                    node or "partition")
+            text += ", needs {5:} more free sectors after it"
+        return text.format(node or "partition", start, new_start - start,
+                           new_start, moved, new_start + length - 1 - high)
+
     @property
     def table_string(self):
         fields = self.partitions_data + (self.table_fields,)
         widths = [max([len(str(v)) for v in vs]) for vs in zip(*fields)]
 
         def format_fields(cols):
-            return "{:<{a}}  {:<{b}}  {:<{c}}  {:<{d}}  {:>{e}}".\
+            return "{:<{a}}  {:<{b}}  {:<{c}}  {:<{d}}  {:<{e}}  {:>{f}}".\
                     format(*cols, a = widths[0], b = widths[1], c = widths[2],
-                           d = widths[3], e = widths[4])
+                           d = widths[3], e = widths[4], f = widths[5])
 
         table = ""
         table += format_fields(self.table_fields) + "\n"
@@ -127,6 +184,14 @@ class Menu(object):
         for part in self.partitions_data:
             table += format_fields(part) + "\n"
 
+        plans = [self.realignment(i) for i in range(len(self.rows))]
+        plans = [plan for plan in plans if plan]
+        if plans:
+            table += "\nAlignment ({:}):\n".format(", ".join(
+                ["{:} {:}s".format(name, grain)
+                 for name, grain, offset in self.alignments]))
+            table += "\n".join(plans) + "\n"
+
         return table
 
     @property
@@ -164,41 +229,81 @@ class Menu(object):
 
     def call(self, option):
         """Attempt to call an option specified by the correspond string."""
-        names, funcs = zip(*self.vis_opts)
+        names, funcs = zip(*(self.vis_opts + self.key_opts))
         if option == "Selected":
-            return funcs[self.selected_option]()
-        try:
-            i = names.index(option)
-            return funcs[i]()
-        except ValueError:
-            self.draw_info("%s is not a legal option for this partition." %
-                           option)
+            func = funcs[self.selected_option]
+        else:
+            try:
+                func = funcs[names.index(option)]
+            except ValueError:
+                self.draw_info("%s is not a legal option for this partition." %
+                               option)
+                return
+        if self.disk is None and func not in self.cached_opts:
+            selected = self.selected_option
+            self.draw_info("Probing {:}...".format(self.device.path))
+            self.window.refresh()
+            self.load_disk()
+            self.select_partition(self.__partition_number)
+            self.selected_option = selected
+        return func()
+
+    def load_disk(self):
+        """Probe the disk, replacing any partition data read from the cache."""
+        self.disk = parted.Disk(self.device)
+        self.problems = check_layout(self.disk)
+        self.partitions = get_partitions(self.disk, debug=DEBUG)
+        bounds = move_bounds(self.disk)
+        self.rows = [partition_row(p, bounds) for p in self.partitions]
+        self.label_type = self.disk.type
+        if CACHE:
+            save_cache(self.disk, self.problems)
 
     def select_partition(self, part):
         """Change the currently selected partition."""
         self.__partition_number = part
-        self.__partition = self.partitions[part]
+        if self.partitions is None:
+            self.__partition = None # Not probed yet, see call.
+        else:
+            self.__partition = self.partitions[part]
         self.selected_option = 0 # Delete/New/Help
-        if self.__partition.type & parted.PARTITION_FREESPACE:
+        type_ = self.rows[part][0]
+        if type_ & parted.PARTITION_FREESPACE:
             self.vis_opts = self.free_opts
-        elif self.__partition.type & parted.PARTITION_METADATA or \
-             self.__partition.type & parted.PARTITION_PROTECTED or \
-             self.__partition.type & parted.PARTITION_EXTENDED:
+        elif type_ & parted.PARTITION_METADATA or \
+             type_ & parted.PARTITION_PROTECTED or \
+             type_ & parted.PARTITION_EXTENDED:
             self.vis_opts = self.meta_opts
         else:
             self.vis_opts = self.part_opts
 
+    def part_problems(self, start, end):
+        """The layout problems that touch the given range of sectors."""
+        return [p for p in self.problems if p[START] <= end and p[END] >= start]
+
+    def draw_problems(self):
+        """Show the first layout problem on the information line."""
+        if self.problems:
+            problem = self.problems[0]
+            self.draw_info("{:}: {:} ({:} problem(s))".format(
+                problem[LEVEL], problem[MESSAGE], len(self.problems)))
+
     def draw_menu(self):
         self.draw_header()
         self.draw_partitions()
         self.draw_options()
+        self.draw_problems()
 
     def refresh_menu(self):
-        self.partitions = get_partitions(self.disk, debug=DEBUG)
+        if self.disk is not None:
+            self.partitions = get_partitions(self.disk, debug=DEBUG)
+            bounds = move_bounds(self.disk)
+            self.rows = [partition_row(p, bounds) for p in self.partitions]
+            self.label_type = self.disk.type
 
-        if self.__partition_number >= len(self.partitions):
+        if self.__partition_number >= len(self.rows):
             self.chgat_partition(curses.A_NORMAL)
-            self.select_partition(len(self.partitions) - 1)
+            self.select_partition(len(self.rows) - 1)
         else:
             self.select_partition(self.__partition_number)
 
@@ -212,8 +317,11 @@ class Menu(object):
 
     def draw_info(self, string):
         """Add information line to the bottom of the main window"""
+        # Writing to the last cell of the window is an error, so stop before it.
+        x = max(self.center(string[:self.window_width - 1]), 0)
         self.window.hline(self.menu_line + 2, 0, " ", self.window_width)
-        self.window.addstr(self.menu_line + 2, self.center(string), string)
+        self.window.addstr(self.menu_line + 2, x,
+                           string[:self.window_width - 1 - x])
 
     def draw_options(self):
         """Redraw the menu when switching partitions."""
@@ -226,8 +334,8 @@ class Menu(object):
             self.draw_info("ERR: window too small")
 
     def format_fields(self, cols):
-        fields = ("{:{a}} {:{a}} {:{a}} {:{a}} {:>{a}}").\
-                  format(*cols, a = int(self.window_width / 5.5))
+        fields = ("{:{a}} {:{a}} {:{a}} {:{a}} {:{a}} {:>{a}}").\
+                  format(*cols, a = int(self.window_width / 6.6))
         return "{:^{:}}".format(fields, self.window_width - 1)
 
     def draw_partitions(self):
@@ -244,7 +352,7 @@ class Menu(object):
                 self.chgat_partition(curses.A_NORMAL)
                 self.select_partition(self.__partition_number - 1)
                 self.chgat_partition(curses.A_STANDOUT)
-        elif self.__partition_number < (len(self.partitions) - 1):
+        elif self.__partition_number < (len(self.rows) - 1):
             self.chgat_partition(curses.A_NORMAL)
             self.select_partition(self.__partition_number + 1)
             self.chgat_partition(curses.A_STANDOUT)
@@ -257,15 +365,17 @@ class Menu(object):
 
     def left_right(self, key):
         num_opts = len(self.vis_opts)
-        self.chgat_option(curses.A_NORMAL)
-
         if key == curses.KEY_LEFT:
             self.selected_option = (self.selected_option - 1) % num_opts
         else:
             self.selected_option = (self.selected_option + 1) % num_opts
 
-        self.chgat_option(curses.A_STANDOUT)
-        self.draw_info(self.vis_opts[self.selected_option][FUNC].__doc__)
+        try:
+            self.window.chgat(self.menu_line, 0, curses.A_NORMAL)
+            self.chgat_option(curses.A_STANDOUT)
+            self.draw_info(self.vis_opts[self.selected_option][FUNC].__doc__)
+        except Exception:
+            self.draw_info("ERR: window too small")
 
     def sub_menu(self, opts):
         """Create a sub-menu, with limited input options, that captures the
@@ -282,7 +392,8 @@ class Menu(object):
             if key == curses.KEY_RIGHT or key == curses.KEY_LEFT:
                 self.left_right(key)
             if key == ord("\n"):
-                return self.call("Selected")
+                # Not through call, which would probe the disk if needed.
+                return self.vis_opts[self.selected_option][FUNC]()
 
     def resize_menu(self):
         try:
@@ -294,9 +405,8 @@ class Menu(object):
     ###########################################################################
     ## Option menu functions
     ###########################################################################
-    def print_(self):
-        """Print partition table to the screen or to a file."""
-        text = "Enter filename, or press RETURN to display on screen: "
+    def prompt(self, text):
+        """Read a line of text from the user on the menu line."""
         offset = self.center(text + (20 * "-"))
         self.window.hline(self.menu_line, 0, " ", self.window_width)
         self.window.addstr(self.menu_line, offset, text)
@@ -304,10 +414,14 @@ class Menu(object):
         editwin = curses.newwin(1, 20, self.menu_line, offset + len(text))
         editwin.erase()
         textbox = curses.textpad.Textbox(editwin)
-        filename = textbox.edit(lambda k: curses.KEY_BACKSPACE if k == 127 else k)
+        return textbox.edit(lambda k: curses.KEY_BACKSPACE if k == 127 else k).strip()
+
+    def print_(self):
+        """Print partition table to the screen or to a file."""
+        filename = self.prompt("Enter filename, or press RETURN to display on screen: ")
         if filename:
             try:
-                with open(filename.strip(), 'a') as f:
+                with open(filename, 'a') as f:
                     f.write(self.table_string)
                     f.flush
             except Exception as e:
@@ -326,6 +440,53 @@ class Menu(object):
 
         self.refresh_menu()
 
+    def backup(self):
+        """Save the partition table sectors on disk to a file."""
+        filename = self.prompt("Enter backup filename: ")
+        self.refresh_menu()
+        if not filename:
+            self.draw_info("Did not back up the partition table.")
+            return
+        try:
+            count = backup_label(self.device, filename)
+        except Exception as e:
+            self.draw_info("ERROR: {:}".format(e))
+            return
+        self.draw_info("Saved {:} sectors to {:}.".format(count, filename))
+
+    def restore(self):
+        """Restore the partition table on disk from a backup (discards changes)."""
+        filename = self.prompt("Enter backup filename: ")
+        self.refresh_menu()
+        if not filename:
+            self.draw_info("Did not restore the partition table.")
+            return
+        self.draw_info("Are you sure you want to overwrite the partition table on disk? y/N")
+        key = self.window.getkey()
+        if key != "y" and key != "Y":
+            self.draw_info("Did not restore the partition table.")
+            return
+        try:
+            reread = restore_label(self.device, filename)
+            self.load_disk()
+        except Exception as e:
+            self.draw_info("ERROR: {:}".format(e))
+            return
+        self.refresh_menu()
+        if reread:
+            self.draw_info("Restored the partition table from {:}.".format(filename))
+        else:
+            self.draw_info("Restored, but the kernel kept the old table. "
+                           "Reboot to use it.")
+
+    def align(self):
+        """Show how to align the current partition."""
+        plan = self.realignment(self.__partition_number, short=True)
+        if plan is None:
+            names = [name for name, grain, offset in self.alignments]
+            plan = "The partition is aligned ({:}).".format(", ".join(names))
+        self.draw_info(plan)
+
     def bootable(self):
         """Toggle bootable flag of the current partition."""
         def toggle_flag(part, flag):
@@ -335,6 +496,8 @@ class Menu(object):
                 part.setFlag(flag)
 
         toggle_flag(self.__partition, parted.PARTITION_BOOT)
+        self.rows[self.__partition_number] = partition_row(
+            self.__partition, move_bounds(self.disk))
         self.draw_partitions()
 
     def delete(self):
@@ -343,7 +506,9 @@ class Menu(object):
         self.disk.deletePartition(self.__partition)
         if logical:
             self.disk.minimizeExtendedPartition()
+        self.problems = check_layout(self.disk)
         self.refresh_menu()
+        self.draw_problems()
 
     def help_(self):
         """Print help screen."""
@@ -358,21 +523,33 @@ Copyright (C) 2011 David Campbell <davekong@archlinux.us>
 
 Command      Meaning
 -------      -------
+  a          Show how to align the current partition. The Align
+             column lists the alignments a partition does not meet:
+             Phys (physical sector size), Min and Opt (libparted's
+             minimum and optimum alignment), and IO (the optimal I/O
+             size of the device). Print includes the moves needed to
+             align every misaligned partition.
   b          Toggle bootable flag of the current partition.
   d          Delete the current partition.
   h          Print this screen.
+  k          Back up the partition table sectors on disk to a file.
   n          Create new partition from free space.
   p          Print partition table to screen or to a file.
              If printing to a file, the table will be appended
              to the given file. The path may be relative or absolute.
   q          Quit program without writing partition table.
+  R          Restore the partition table on disk from a backup file
+             (must enter upper case R). Unwritten changes are lost.
   t          Create a new partition table.
   u          Change units of the partition size display and used to
              create new partitions.
   W          Write partition table to disk (must enter upper case W).
              Since this might destroy data on the disk, you must
              either confirm or deny the write by entering `y' (yes) or
-             `n' (no).
+             `n' (no). The write is refused if the layout has errors,
+             such as overlapping partitions or adjacent regions of
+             free space. Partitions with layout problems are marked
+             with a `!' in front of their name.
 Up Arrow     Move cursor to the previous partition.
 Down Arrow   Move cursor to the next partition.
 CTRL-L       Redraws the screen.
@@ -417,11 +594,22 @@ Note: All of the commands can be entered with either upper or lower
 
     def write(self):
         """Write partition table to disk (this might destroy data)."""
-        self.draw_info("Are you sure you want to write the partition table to disk? y/N")
+        errors = [p for p in self.problems if p[LEVEL] == "ERROR"]
+        if errors:
+            self.draw_info("Refusing to write, ERROR: {:}".format(
+                errors[0][MESSAGE]))
+            return
+        if self.problems:
+            self.draw_info("{:} warning(s), write the partition table anyway? y/N"
+                           .format(len(self.problems)))
+        else:
+            self.draw_info("Are you sure you want to write the partition table to disk? y/N")
         key = self.window.getkey()
         if key == "y" or key == "Y":
             self.draw_info("Writing changes to disk...")
             self.disk.commit()
+            if CACHE:
+                save_cache(self.disk, self.problems)
         else:
             self.draw_info("Did not write changes to disk.")
 
@@ -531,13 +719,16 @@ Note: All of the commands can be entered with either upper or lower
         except Exception as e:
             if part_type == parted.PARTITION_LOGICAL:
                 self.disk.minimizeExtendedPartition()
+            self.problems = check_layout(self.disk)
             self.refresh_menu()
             self.draw_info("ERROR: {:}".format(e))
             return
 
         if part_type == parted.PARTITION_LOGICAL:
             self.disk.minimizeExtendedPartition()
+        self.problems = check_layout(self.disk)
         self.refresh_menu()
+        self.draw_problems()
 
     def new_table(self):
         """Create a new partition table on the device."""
@@ -546,6 +737,7 @@ Note: All of the commands can be entered with either upper or lower
         ty = self.sub_menu(tuple([(f(), f) for f in fs]) + (("Cancel", cancel),))
         if ty:
             self.disk = parted.freshDisk(self.device, ty)
+            self.problems = check_layout(self.disk)
         self.refresh_menu()
 
 
@@ -556,6 +748,99 @@ def make_fn(ret, doc=""):
     return fn
 
 
+def partition_row(part, bounds):
+    """Get the data Menu displays for a partition.
+
+    Returns a (type, name, flags, part type, fs type, start, end, low, high)
+    tuple, which only holds plain values so that it can be stored in the cache.
+    low and high are the sectors the partition could be moved within, looked
+    up in bounds, the result of move_bounds.
+
+    """
+    def if_active(fn):
+        if part.active:
+            return fn()
+        return ""
+
+    if part.fileSystem:
+        fs_type = part.fileSystem.type
+    elif part.type & parted.PARTITION_FREESPACE:
+        fs_type = "Free Space"
+    else:
+        fs_type = ""
+
+    if part.type & parted.PARTITION_FREESPACE:
+        part_type = check_free_space(part)
+    elif part.type == parted.PARTITION_NORMAL:
+        part_type = "Primary"
+    else:
+        flags = []
+        for flag, value in zip(bin(part.type)[::-1], PART_TYPES):
+            if flag == "1":
+                flags.append(value)
+        part_type = ", ".join(flags)
+
+    if part.type & SPACE_TYPES:
+        low, high = part.geometry.start, part.geometry.end
+    else:
+        low, high = bounds[part.geometry.start]
+
+    return (part.type, if_active(part.getDeviceNodeName),
+            if_active(part.getFlagsAsString), part_type, fs_type,
+            part.geometry.start, part.geometry.end, low, high)
+
+
+def move_bounds(disk):
+    """Find the sectors each partition of disk could be moved within.
+
+    A partition may move into the free space directly before or after it.
+    Logical partitions stay inside of the extended partition and after the
+    EBRs before them, which the partitions of the msdos label are linked
+    through. Returns a dictionary mapping the start sector of every partition
+    to a (low, high) tuple.
+
+    """
+    parts = get_partitions(disk, debug=True)
+    parts.sort(key=lambda p: p.geometry.start)
+    ext = disk.getExtendedPartition()
+    bounds = {}
+    # Primary partitions sit next to the extended partition, logical partitions
+    # next to the free space and metadata inside of it.
+    for level in (0, parted.PARTITION_LOGICAL):
+        siblings = [p for p in parts if p.type & parted.PARTITION_LOGICAL == level]
+        # The first sector of the extended partition always holds an EBR.
+        after_ebr = ext.geometry.start + 1 if ext else 0
+        for i, part in enumerate(siblings):
+            if part.type & parted.PARTITION_METADATA:
+                after_ebr = max(after_ebr, part.geometry.end + 1)
+            if part.type & SPACE_TYPES:
+                continue
+            low, high = part.geometry.start, part.geometry.end
+            if i > 0 and siblings[i - 1].type & parted.PARTITION_FREESPACE:
+                low = siblings[i - 1].geometry.start
+            if i + 1 < len(siblings) and \
+               siblings[i + 1].type & parted.PARTITION_FREESPACE:
+                high = siblings[i + 1].geometry.end
+            if level:
+                low = max(low, after_ebr)
+                high = min(high, ext.geometry.end)
+            bounds[part.geometry.start] = (low, high)
+    return bounds
+
+
+def format_bytes(size):
+    """Format a number of bytes in the largest binary unit it fills."""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = "TiB"
+    if unit == "B":
+        return "{:} B".format(size)
+    return "{:.1f} {:}".format(size, unit)
+
+
 def get_partitions(disk, ext=None, debug=None):
     """Get all primary, logical, and free space partitions.
 
@@ -587,6 +872,75 @@ def get_partitions(disk, ext=None, debug=None):
     return parts
 
 
+def check_layout(disk):
+    """Check the partition layout of disk for problems.
+
+    The partitions are swept in sector order looking for overlapping
+    partitions, adjacent regions of free space, logical partitions outside of
+    the extended partition, and partitions that miss one of the alignments of
+    alignment_requirements.
+    Each problem is a (start, end, level, message) tuple, where level is
+    "ERROR" if writing the table would corrupt it and "WARNING" otherwise.
+
+    The whole disk is checked after every change. Labels hold at most 128
+    partitions, and libparted's partition list has to be walked from the start
+    to find any one of them, so checking only around the change would not
+    save any real work.
+
+    """
+    def is_meta(part):
+        return part.type & (parted.PARTITION_METADATA |
+                            parted.PARTITION_PROTECTED)
+
+    def is_free(part):
+        return part.type & parted.PARTITION_FREESPACE and \
+               part.getLength() >= grain
+
+    grain = disk.device.optimumAlignment.grainSize
+    alignments = alignment_requirements(disk.device)
+    ext = disk.getExtendedPartition()
+    parts = [p for p in get_partitions(disk, debug=True)
+             if not p.type & parted.PARTITION_EXTENDED]
+    parts.sort(key=lambda p: (p.geometry.start, p.geometry.end))
+
+    problems = []
+    last = None # The partition reaching furthest into the disk so far.
+    prev_used = None
+    for part in parts:
+        geom = part.geometry
+        if last and geom.start <= last.geometry.end:
+            problems.append((last.geometry.start,
+                             max(geom.end, last.geometry.end), "ERROR",
+                             "sectors {:}-{:} overlap".format(
+                                 geom.start, min(geom.end, last.geometry.end))))
+        if last is None or geom.end > last.geometry.end:
+            last = part
+
+        if is_meta(part):
+            continue
+        if is_free(part) and prev_used and is_free(prev_used):
+            problems.append((prev_used.geometry.start, geom.end, "ERROR",
+                             "adjacent free space at sectors {:} and {:}".
+                             format(prev_used.geometry.start, geom.start)))
+        if not part.type & parted.PARTITION_FREESPACE or is_free(part):
+            prev_used = part
+
+        if part.type & parted.PARTITION_FREESPACE:
+            continue
+        if part.type & parted.PARTITION_LOGICAL and \
+           (ext is None or not ext.geometry.contains(geom)):
+            problems.append((geom.start, geom.end, "ERROR",
+                             "logical partition at sector {:} is outside of "
+                             "the extended partition".format(geom.start)))
+        missed = check_alignment(alignments, geom.start)
+        if missed:
+            problems.append((geom.start, geom.end, "WARNING",
+                             "partition at sector {:} is not aligned ({:})".
+                             format(geom.start, ", ".join(missed))))
+
+    return problems
+
+
 def grow_ext(part):
     """Grow, or create and grow, an extended partition to max size."""
     ext = part.disk.getExtendedPartition()
@@ -647,12 +1001,307 @@ def next_to_extended(part):
     return False
 
 
-def start_curses(stdscr, device):
+def sysfs_attr(device, attr):
+    """Read an attribute of device from sysfs, or None if it is missing."""
+    name = os.path.basename(os.path.realpath(device.path))
+    try:
+        with open("/sys/class/block/{:}/{:}".format(name, attr)) as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+
+def device_serial(device):
+    """The WWN or serial number of device, or its model if neither is known."""
+    for attr in ("wwid", "device/wwid", "device/serial"):
+        serial = sysfs_attr(device, attr)
+        if serial:
+            return serial
+    return device.model
+
+
+def alignment_requirements(device):
+    """Get the alignments partitions on device should start at.
+
+    Returns a list of (name, grain size, offset) tuples in sectors, for the
+    physical sector size, libparted's minimum and optimum alignment, and the
+    optimal I/O size the kernel reports in sysfs. Alignments every sector
+    meets are left out.
+
+    """
+    minimum = device.minimumAlignment
+    optimum = device.optimumAlignment
+    requirements = [
+        ("Phys", device.physicalSectorSize // device.sectorSize, minimum.offset),
+        ("Min", minimum.grainSize, minimum.offset),
+        ("Opt", optimum.grainSize, optimum.offset)]
+    try:
+        io_size = int(sysfs_attr(device, "queue/optimal_io_size"))
+    except (TypeError, ValueError):
+        io_size = 0
+    # Some devices report sizes that are not whole physical sectors.
+    if io_size and io_size % device.physicalSectorSize == 0:
+        requirements.append(("IO", io_size // device.sectorSize, minimum.offset))
+    return [(name, grain, offset % grain)
+            for name, grain, offset in requirements if grain > 1]
+
+
+def check_alignment(requirements, start):
+    """The names of the alignment requirements start does not meet."""
+    return [name for name, grain, offset in requirements
+            if (start - offset) % grain]
+
+
+def plan_realignment(requirements, start, length, low, high=None):
+    """Find the aligned start sector closest to start.
+
+    The partition of length sectors may be moved anywhere between the sectors
+    low and high, or past the end of the device if high is None. Returns the
+    new start sector, or None if no aligned start fits.
+
+    """
+    # Every requirement is met at the sectors offset + n * grain.
+    grain = 1
+    for name, g, o in requirements:
+        a, b = grain, g
+        while b:
+            a, b = b, a % b
+        grain = grain * g // a
+    name, g, o = max(requirements, key=lambda r: r[1])
+    for offset in range(o, grain, g):
+        if not check_alignment(requirements, offset):
+            break
+    else:
+        return None # The offsets can't all be met at once.
+
+    down = start - (start - offset) % grain
+    candidates = [down, down + grain]
+    candidates.sort(key=lambda s: abs(s - start))
+    for new_start in candidates:
+        if new_start >= low and (high is None or new_start + length - 1 <= high):
+            return new_start
+    return None
+
+
+def read_sectors(f, sector_size, start, count=1):
+    f.seek(start * sector_size)
+    data = f.read(count * sector_size)
+    if len(data) != count * sector_size:
+        raise IOError("short read at sector {:}".format(start))
+    return data
+
+
+def label_ranges(f, sector_size, length):
+    """Find the sectors holding the partition table on disk.
+
+    Returns a list of (start, count) tuples covering the MBR and every EBR in
+    the chain of an msdos label, or the protective MBR, headers and partition
+    entry arrays of a gpt label. The label is read directly from f, so any
+    unwritten changes are not included.
+
+    """
+    mbr = read_sectors(f, sector_size, 0)
+    header = read_sectors(f, sector_size, 1)
+    if header[:8] == GPT_SIGNATURE:
+        backup_lba, = struct.unpack_from("<Q", header, 32)
+        entries_lba, entries, entry_size = struct.unpack_from("<QII", header, 72)
+        count = -(-entries * entry_size // sector_size)
+        ranges = [(0, 1), (1, 1), (entries_lba, count)]
+        if 0 < backup_lba < length:
+            backup = read_sectors(f, sector_size, backup_lba)
+            if backup[:8] == GPT_SIGNATURE:
+                entries_lba, = struct.unpack_from("<Q", backup, 72)
+                ranges += [(entries_lba, count), (backup_lba, 1)]
+        return ranges
+
+    if mbr[510:512] != b"\x55\xaa":
+        raise ValueError("no msdos or gpt partition table on disk")
+    ranges = [(0, 1)]
+    for i in range(4):
+        type_, ext = struct.unpack_from("<B3xI", mbr, 446 + 16 * i + 4)
+        if type_ not in MSDOS_EXTENDED:
+            continue
+        # Follow the chain of EBRs, each of which points to the next one. A
+        # damaged chain may point anywhere, so stop at the first sector that
+        # is not an EBR.
+        ebr = ext
+        while 0 < ebr < length and (ebr, 1) not in ranges:
+            sector = read_sectors(f, sector_size, ebr)
+            if sector[510:512] != b"\x55\xaa":
+                break
+            ranges.append((ebr, 1))
+            type_, next_ = struct.unpack_from("<B3xI", sector, 446 + 16 + 4)
+            if type_ not in MSDOS_EXTENDED:
+                break
+            ebr = ext + next_
+    return ranges
+
+
+def backup_label(device, filename):
+    """Save the partition table sectors of device to filename.
+
+    The file holds the device's serial number, size and sector size, followed
+    by the compressed sector ranges and data, and ends with a CRC32 of all of
+    the preceding bytes. Returns the number of sectors saved.
+
+    """
+    sector_size = device.sectorSize
+    with open(device.path, "rb") as f:
+        ranges = label_ranges(f, sector_size, device.length)
+        data = [read_sectors(f, sector_size, start, count)
+                for start, count in ranges]
+
+    serial = device_serial(device).encode("utf-8")
+    body = struct.pack("<I", len(ranges))
+    body += b"".join([struct.pack("<QI", start, count)
+                      for start, count in ranges])
+    body += b"".join(data)
+    backup = struct.pack(BACKUP_HEADER, BACKUP_MAGIC, BACKUP_VERSION,
+                         sector_size, device.length, len(serial))
+    backup += serial + zlib.compress(body, 9)
+    backup += struct.pack("<I", zlib.crc32(backup) & 0xffffffff)
+    with open(filename, "wb") as f:
+        f.write(backup)
+    return sum([count for start, count in ranges])
+
+
+def restore_label(device, filename):
+    """Write the partition table sectors saved in filename back to device.
+
+    The backup must have been taken from the same device. The sectors of the
+    partition table now on disk that the backup does not cover, such as the
+    GPT headers left by a gpt table when restoring an msdos backup, are
+    zeroed first so that no stale table is left behind. Once the sectors are
+    written, the kernel is asked to re-read the partition table. Returns False
+    if it could not, which happens when partitions on the device are in use.
+
+    """
+    with open(filename, "rb") as f:
+        backup = f.read()
+    crc, = struct.unpack("<I", backup[-4:])
+    if zlib.crc32(backup[:-4]) & 0xffffffff != crc:
+        raise ValueError("{:} is corrupted (bad checksum)".format(filename))
+    size = struct.calcsize(BACKUP_HEADER)
+    magic, version, sector_size, length, serial_length = \
+        struct.unpack(BACKUP_HEADER, backup[:size])
+    if magic != BACKUP_MAGIC or version != BACKUP_VERSION:
+        raise ValueError("{:} is not a cparted backup".format(filename))
+    serial = backup[size:size + serial_length].decode("utf-8")
+    if serial != device_serial(device) or length != device.length or \
+       sector_size != device.sectorSize:
+        raise ValueError("{:} is a backup of a different device".format(filename))
+
+    body = zlib.decompress(backup[size + serial_length:-4])
+    num_ranges, = struct.unpack_from("<I", body)
+    ranges = [struct.unpack_from("<QI", body, 4 + 12 * i)
+              for i in range(num_ranges)]
+    offset = 4 + 12 * num_ranges
+    with open(device.path, "r+b") as f:
+        try:
+            stale = [r for r in label_ranges(f, sector_size, length)
+                     if r not in ranges]
+        except ValueError:
+            stale = [] # No partition table on disk.
+        for start, count in stale:
+            f.seek(start * sector_size)
+            f.write(b"\0" * (count * sector_size))
+        for start, count in ranges:
+            f.seek(start * sector_size)
+            f.write(body[offset:offset + count * sector_size])
+            offset += count * sector_size
+        f.flush()
+        os.fsync(f.fileno())
+        try:
+            fcntl.ioctl(f.fileno(), BLKRRPART)
+        except IOError:
+            return False
+    return True
+
+
+def cache_path(device):
+    """The file device is cached in, under $XDG_CACHE_HOME, /var/cache for
+    root, or ~/.cache."""
+    if os.environ.get("XDG_CACHE_HOME"):
+        directory = os.environ["XDG_CACHE_HOME"]
+    elif os.geteuid() == 0:
+        directory = "/var/cache"
+    else:
+        directory = os.path.expanduser("~/.cache")
+    name = re.sub(r"[^\w.-]", "_", device_serial(device))
+    return os.path.join(directory, "cparted",
+                        "{:}-{:}.json".format(name, device.length))
+
+
+def label_checksum(device):
+    """A SHA-1 of the partition table sectors of device."""
+    sha = hashlib.sha1()
+    with open(device.path, "rb") as f:
+        for start, count in label_ranges(f, device.sectorSize, device.length):
+            sha.update(read_sectors(f, device.sectorSize, start, count))
+    return sha.hexdigest()
+
+
+def load_cache(device):
+    """Get the cached partition data of device.
+
+    The cache is only used if it was saved for a device with the same serial
+    number, size and sector size, and the partition table sectors on disk are
+    unchanged since. Otherwise, or if the cache can not be read, None is
+    returned and the disk has to be probed.
+
+    """
+    try:
+        with open(cache_path(device)) as f:
+            cache = json.load(f)
+        if cache["version"] != CACHE_VERSION or \
+           cache["serial"] != device_serial(device) or \
+           cache["length"] != device.length or \
+           cache["sector_size"] != device.sectorSize or \
+           cache["label"] != label_checksum(device):
+            return None
+        for key in ("partitions", "debug", "problems"):
+            cache[key] = [tuple(v) for v in cache[key]]
+        return cache
+    except Exception:
+        return None
+
+
+def save_cache(disk, problems):
+    """Cache the partition data of disk, which must match what is on disk.
+
+    The cache is optional, so failing to write it is not an error.
+
+    """
+    device = disk.device
+    bounds = move_bounds(disk)
+    cache = {"version": CACHE_VERSION,
+             "serial": device_serial(device),
+             "length": device.length,
+             "sector_size": device.sectorSize,
+             "type": disk.type,
+             "partitions": [partition_row(p, bounds)
+                            for p in get_partitions(disk)],
+             "debug": [partition_row(p, bounds) for p in
+                       get_partitions(disk, debug=True)],
+             "problems": problems}
+    try:
+        cache["label"] = label_checksum(device)
+        path = cache_path(device)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + ".tmp", "w") as f:
+            json.dump(cache, f)
+        os.rename(path + ".tmp", path)
+    except Exception:
+        pass
+
+
+def start_curses(stdscr, device, cache=None):
     # Allow capture of KEY_ENTER via '\n'.
     curses.nl()
 
     # Draw the header, partitions table, and options menu
-    menu = Menu(stdscr, device)
+    menu = Menu(stdscr, device, cache)
     menu.draw_menu()
 
     # The main loop that captures user input.
@@ -668,6 +1317,8 @@ def start_curses(stdscr, device):
             menu.left_right(key)
         if key == ord("\n"):
             menu.call("Selected")
+        if key == ord("a") or key == ord("A"):
+            menu.call("Align")
         if key == ord("b") or key ==  ord("B"):
             menu.call("Bootable")
         if key == ord("d") or key ==  ord("D"):
@@ -686,16 +1337,27 @@ def start_curses(stdscr, device):
             menu.call("New Table")
         if key == ord("W"):
             menu.call("Write")
+        if key == ord("k") or key == ord("K"):
+            menu.call("Backup")
+        if key == ord("R"):
+            menu.call("Restore")
 
 
 def main():
+    global DEBUG, CACHE
+    cache = None
     try:
-        if sys.argv[1] == "--debug":
+        while sys.argv[1] in ("--debug", "--cache"):
+            if sys.argv[1] == "--debug":
+                DEBUG = True
+            else:
+                CACHE = True
             del sys.argv[1]
-            global DEBUG
-            DEBUG = True
         device = parted.getDevice(sys.argv[1])
-        parted.Disk(device).minimizeExtendedPartition()
+        if CACHE:
+            cache = load_cache(device)
+        if cache is None:
+            parted.Disk(device).minimizeExtendedPartition()
     except IndexError:
         sys.stderr.write("ERROR: you must enter a device path\n")
         sys.exit(1)
@@ -703,7 +1365,7 @@ def main():
         sys.stderr.write("ERROR: %s\n" % e)
         sys.exit(1)
     else:
-        curses.wrapper(start_curses, device)
+        curses.wrapper(start_curses, device, cache)
 
 
 if __name__ == "__main__":